@@ -3,10 +3,29 @@ import subprocess
 import re
 import json
 import shutil
-from groq import Groq
+import hashlib
+import tempfile
+import argparse
+import functools
+import asyncio
+import orjson
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from groq import Groq, DefaultHttpxClient
 
 TARGET_FILE = "fastapi/applications.py"
 ITERATIONS = 3  # each model is run 3 times for reliability
+SAMPLES_PER_REQUEST = 1  # completions per API call (n); Groq currently only accepts n=1
+MAX_CONCURRENT_REQUESTS = 9  # in-flight Groq calls, so large --iterations don't trip rate limits
+TEMPERATURE = 0.7
+CACHE_DIR = ".llm_cache"  # on-disk completion cache, enabled with LLM_CACHE=1
+# tmpfs parent for pytest's scratch dir; only ever used via mkdtemp(), so B108 doesn't apply
+TMPFS_DIR = "/dev/shm"  # nosec B108
+PYTEST_REPORT = "_r.json"  # pytest-json-report output, read instead of scraping stdout
+# loadgroup honours FastAPI's xdist_group("workdir_lock") marks, which pin the tests sharing ./log.txt to one worker
+PYTEST_CMD = ['pytest', 'tests', '-q', '--tb=no', '--disable-warnings', '-p', 'no:cacheprovider', '-n', 'auto', '--dist', 'loadgroup',
+              '--json-report', f'--json-report-file={PYTEST_REPORT}', '--json-report-summary']
+CODE_NOISE = re.compile(r"```python|```|<think>.*?</think>", re.DOTALL)  # fences + reasoning blocks, stripped in one pass
 TASK_PROMPT = """
 Write a new method for the FastAPI class called 'secure_headers'.
 It should add 'X-Frame-Options: DENY' and 'X-Content-Type-Options: nosniff' to every response.
@@ -15,36 +34,112 @@ Provide ONLY the Python code for the method. Do not include the class definition
 
 # UTILS
 
+@functools.lru_cache(maxsize=128)  # pure on its input; identical completions are common across seeds/samples
 def clean_code(code):
-    code = re.sub(r"```python", "", code)
-    code = re.sub(r"```", "", code)
-    code = re.sub(r"<think>.*?</think>", "", code, flags=re.DOTALL)
+    code = CODE_NOISE.sub("", code)
     lines = code.split('\n')
     clean_lines = []
     started = False
     for line in lines:
-        if line.strip().startswith("def ") or line.strip().startswith("@"):
+        if not started and line.lstrip().startswith(("def ", "@")):
             started = True
         if started: clean_lines.append(line)
     return "\n" + "\n".join(clean_lines) + "\n" if clean_lines else "\n" + code.strip() + "\n"
 
-def run_tests():
-    res = subprocess.run(['pytest', 'tests', '-q', '--disable-warnings', '-p', 'no:cacheprovider'], capture_output=True, text=True)
-    match = re.search(r'(\d+) passed', res.stdout)
-    passed = int(match.group(1)) if match else 0
+def cache_get(key):
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    if os.path.exists(path):
+        with open(path) as f: return json.load(f)
 
-    res_sec = subprocess.run(['bandit', '-r', TARGET_FILE, '-f', 'json'], capture_output=True, text=True)
+def cache_set(key, val):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # swap in a complete file, so a killed run can't leave a truncated entry behind
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    with open(path + ".tmp", "w") as f: json.dump(val, f)
+    os.replace(path + ".tmp", path)
+
+def call_model(client, model_id, seed, n=SAMPLES_PER_REQUEST):
+    messages = [{"role": "user", "content": TASK_PROMPT}]
+    use_cache = os.environ.get("LLM_CACHE") == "1"
+    # an explicit per-request seed keeps the cache key deterministic at temperature > 0
+    key = hashlib.sha256(json.dumps({"model": model_id, "messages": messages, "temp": TEMPERATURE, "n": n, "seed": seed}).encode()).hexdigest()
+    cached = cache_get(key) if use_cache else None
+
+    if cached is None:
+        stream = client.chat.completions.create(
+            messages=messages,
+            model=model_id,
+            temperature=TEMPERATURE,
+            n=n,
+            seed=seed,
+            stream=True
+        )
+        parts, usage = {}, None
+        for chunk in stream:
+            for choice in chunk.choices:
+                parts.setdefault(choice.index, []).append(choice.delta.content or "")
+            # Groq reports usage on the final chunk of a stream, and a stream stopped early
+            # through x_groq.error, which the SDK doesn't raise on its own
+            if chunk.x_groq and chunk.x_groq.error: raise RuntimeError(f"stream stopped early: {chunk.x_groq.error}")
+            if chunk.x_groq and chunk.x_groq.usage: usage = chunk.x_groq.usage
+        cached = {"contents": ["".join(parts[idx]) for idx in sorted(parts)],
+                  "total_tokens": usage.total_tokens if usage else 0}
+        # only a stream that ran to its usage block is complete enough to replay later
+        if use_cache and usage: cache_set(key, cached)
+
+    # the prompt is prefilled once for all samples, so split usage evenly across them
+    tokens = cached["total_tokens"] / len(cached["contents"])
+    return [(clean_code(content), tokens) for content in cached["contents"]]
+
+def write_target(content):
+    # write to a sibling temp file and swap it in, so pytest never sees a half-written module
+    tmp = TARGET_FILE + ".tmp"
+    with open(tmp, "wb") as f: f.write(content)
+    os.replace(tmp, TARGET_FILE)
+
+_BANDIT_CACHE = {}  # sha256 of TARGET_FILE -> Medium/High issue count
+
+async def run_bandit():
     security = 0
     try:
-        metrics = json.loads(res_sec.stdout).get('metrics', {}).get('_totals', {})
-        security = metrics.get('SEVERITY.HIGH', 0) + metrics.get('SEVERITY.MEDIUM', 0)
+        # one severity per line is all we need; skips building and parsing the full JSON report
+        proc = await asyncio.create_subprocess_exec('bandit', '-r', TARGET_FILE, '-q', '-f', 'custom', '--msg-template', '{severity}',
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stdout, _ = await proc.communicate()
+        security = sum(line.strip() in (b"HIGH", b"MEDIUM") for line in stdout.splitlines())
+    except: pass
+    return security
+
+async def run_tests(basetemp):
+    # bandit only looks at TARGET_FILE, so its content hash fully determines the result
+    with open(TARGET_FILE, "rb") as f: digest = hashlib.sha256(f.read()).hexdigest()
+
+    # drop the previous run's report so a crashed pytest can't be scored with stale numbers
+    if os.path.exists(PYTEST_REPORT): os.remove(PYTEST_REPORT)
+
+    # pytest (dynamic) and bandit (static) don't share state, so run them side by side on one
+    # event loop, which also keeps bandit's pipes drained while pytest runs.
+    # pytest stays out-of-process: every run must import the freshly written TARGET_FILE,
+    # which an in-proc pytest.main() with cached fastapi modules would not do reliably
+    tests = await asyncio.create_subprocess_exec(*PYTEST_CMD, f'--basetemp={basetemp}', stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    if digest in _BANDIT_CACHE: rc = await tests.wait()
+    else: rc, _BANDIT_CACHE[digest] = await asyncio.gather(tests.wait(), run_bandit())
+
+    # internal/usage errors (e.g. xdist or json-report missing) and interrupts that never wrote a
+    # report say nothing about the generated code; collection errors still write one and score 0
+    if rc in (3, 4) or (rc == 2 and not os.path.exists(PYTEST_REPORT)):
+        raise RuntimeError(f"pytest exited with code {rc}")
+
+    passed = 0
+    try:
+        with open(PYTEST_REPORT, "rb") as f: passed = orjson.loads(f.read())['summary'].get('passed', 0)
     except: pass
-    return passed, security
+    return passed, _BANDIT_CACHE[digest]
 
 # HTML GENERATOR ---
 
-def generate_html_report(results):
-    html_content = f"""
+# Static page chrome is formatted once at import; only the table rows vary per report
+_HTML_HEAD = f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -97,16 +192,7 @@ def generate_html_report(results):
                 </thead>
                 <tbody>
     """
-    for res in results:
-        html_content += f"""
-                    <tr>
-                        <td><strong>{res['Agent']}</strong></td>
-                        <td><span class="pass">{res['Consistency %']}</span></td>
-                        <td>{res['Avg Tokens']}</td>
-                        <td>{res['Total Sec']}</td>
-                    </tr>
-        """
-    html_content += """
+_HTML_TAIL = """
                 </tbody>
             </table>
 
@@ -118,54 +204,85 @@ def generate_html_report(results):
     </body>
     </html>
     """
+
+def generate_html_report(results):
+    rows = [f"""
+                    <tr>
+                        <td><strong>{res['Agent']}</strong></td>
+                        <td><span class="pass">{res['Consistency %']}</span></td>
+                        <td>{res['Avg Tokens']}</td>
+                        <td>{res['Total Sec']}</td>
+                    </tr>
+        """ for res in results]
+    html_content = _HTML_HEAD + "".join(rows) + _HTML_TAIL
     with open("dashboard.html", "w") as f: f.write(html_content)
     print("\n✅ Dashboard generated: dashboard.html")
 
 # MAIN
 
 def main():
-    print(f" Initiating Cross-Model Reliability Benchmarking ({ITERATIONS} runs per model)...")
+    parser = argparse.ArgumentParser(description="Cross-model reliability benchmark against FastAPI.")
+    parser.add_argument("--only", metavar="MODEL_ID", help="only run contenders whose model id contains this substring")
+    parser.add_argument("--iterations", type=int, default=ITERATIONS, help=f"runs per model (default: {ITERATIONS})")
+    args = parser.parse_args()
+    iterations = args.iterations
+    if iterations < 1: parser.error("--iterations must be at least 1")
+
+    print(f" Initiating Cross-Model Reliability Benchmarking ({iterations} runs per model)...")
     contenders = [
         ("Llama 3.3 (70B)", "llama-3.3-70b-versatile"),
         ("Llama 3.1 (8B)", "llama-3.1-8b-instant"),
         ("Qwen 3 (32B)", "qwen/qwen3-32b")
     ]
+    if args.only:
+        contenders = [(name, model_id) for name, model_id in contenders if args.only in model_id]
+        if not contenders: parser.error(f"no contender model id matches '{args.only}'")
 
     results = []
-    client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+    # One persistent HTTP/2 connection pool shared by all requests, so TLS is negotiated once
+    client = Groq(
+        api_key=os.environ.get("GROQ_API_KEY"),
+        http_client=DefaultHttpxClient(http2=True, limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60.0))
+    )
+
+    # Snapshot the pristine target once; each run then writes snapshot + generated method in one go
+    subprocess.run(['git', 'checkout', '--', TARGET_FILE], capture_output=True)
+    with open(TARGET_FILE, "rb") as f: orig = f.read()
+
+    # Private pytest scratch space, on tmpfs where available so per-run temp files stay off disk
+    basetemp = tempfile.mkdtemp(prefix="pytbench-", dir=TMPFS_DIR if os.path.isdir(TMPFS_DIR) else None)
 
     try:
-        for name, model_id in contenders:
-            print(f"\n Testing {name}...")
-            success_count, total_tokens, total_sec = 0, 0, 0
-
-            for i in range(ITERATIONS):
-                # Standard reset before each run
-                subprocess.run(['git', 'checkout', '--', TARGET_FILE], capture_output=True)
-
-                try:
-                    completion = client.chat.completions.create(
-                        messages=[{"role": "user", "content": TASK_PROMPT}],
-                        model=model_id,
-                        temperature=0.7
-                    )
-                    code = clean_code(completion.choices[0].message.content)
-                    with open(TARGET_FILE, "a") as f: f.write(code)
-
-                    passed, security = run_tests()
-                    if passed >= 3032: success_count += 1
-                    total_sec += security
-                    total_tokens += completion.usage.total_tokens
-                    print(f"   - Run {i+1}: {'✅ PASS' if passed >= 3032 else '❌ FAIL'}")
-                except Exception as e:
-                    print(f"   - Run {i+1}: ❌ ERROR: {e}")
-
-            results.append({
-                "Agent": name,
-                "Consistency %": f"{(success_count / ITERATIONS) * 100:.1f}%",
-                "Avg Tokens": int(total_tokens / ITERATIONS),
-                "Total Sec": total_sec
-            })
+        # Groq calls are I/O-bound, so fire them all off concurrently; only the
+        # write + test stage below has to stay serial since it mutates TARGET_FILE
+        requests_per_model = -(-iterations // SAMPLES_PER_REQUEST)
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(contenders) * requests_per_model)) as pool:
+            futures = {name: [pool.submit(call_model, client, model_id, seed) for seed in range(requests_per_model)]
+                       for name, model_id in contenders}
+
+            for name, _ in contenders:
+                print(f"\n Testing {name}...")
+                success_count, total_tokens, total_sec = 0, 0, 0
+
+                for i in range(iterations):
+                    try:
+                        code, tokens = futures[name][i // SAMPLES_PER_REQUEST].result()[i % SAMPLES_PER_REQUEST]
+                        write_target(orig + code.encode())
+
+                        passed, security = asyncio.run(run_tests(basetemp))
+                        if passed >= 3032: success_count += 1
+                        total_sec += security
+                        total_tokens += tokens
+                        print(f"   - Run {i+1}: {'✅ PASS' if passed >= 3032 else '❌ FAIL'}")
+                    except Exception as e:
+                        print(f"   - Run {i+1}: ❌ ERROR: {e}")
+
+                results.append({
+                    "Agent": name,
+                    "Consistency %": f"{(success_count / iterations) * 100:.1f}%",
+                    "Avg Tokens": int(total_tokens / iterations),
+                    "Total Sec": total_sec
+                })
 
         # Generate the report only if the loops finished successfully
         generate_html_report(results)
@@ -174,7 +291,8 @@ def main():
         # Reset target file
         subprocess.run(['git', 'checkout', '--', TARGET_FILE], capture_output=True)
 
-        for p in ["log.txt", "coverage", ".pytest_cache"]:
+        shutil.rmtree(basetemp, ignore_errors=True)
+        for p in ["log.txt", "coverage", ".pytest_cache", PYTEST_REPORT, TARGET_FILE + ".tmp"]:
             if os.path.exists(p):
                 if os.path.isdir(p): shutil.rmtree(p)
                 else: os.remove(p)